@@ -1,14 +1,17 @@
 """Visualization Callbacks."""
 
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+
 import numpy as np
 import pytorch_lightning as pl
 import torch
 import torchvision
 from matplotlib import pyplot as plt
+from matplotlib.collections import LineCollection
+from matplotlib.colors import Normalize
 from torch.utils.data import DataLoader, Dataset
 
-from ..utils.utils import mesh2d
-
 
 class Vis2DAbstract(pl.Callback):
     def __init__(self,
@@ -18,31 +21,58 @@ class Vis2DAbstract(pl.Callback):
                  border=0.1,
                  resolution=100,
                  flatten_data=True,
+                 max_plot_points=5000,
+                 quantize_mesh=False,
                  axis_off=False,
                  show_protos=True,
                  show=True,
                  tensorboard=False,
                  show_last_only=False,
+                 every_n_epochs=1,
                  pause_time=0.1,
                  block=False):
         super().__init__()
 
         if isinstance(data, Dataset):
-            x, y = next(iter(DataLoader(data, batch_size=len(data))))
+            if hasattr(data, "tensors") and len(data.tensors) == 2:
+                x, y = data.tensors  # TensorDataset: use the tensors as-is
+            else:
+                x, y = next(iter(DataLoader(data, batch_size=len(data))))
         elif isinstance(data, torch.utils.data.DataLoader):
-            x = torch.tensor([])
-            y = torch.tensor([])
+            xs, ys = [], []
             for x_b, y_b in data:
-                x = torch.cat([x, x_b])
-                y = torch.cat([y, y_b])
+                xs.append(x_b)
+                ys.append(y_b)
+            x = torch.cat(xs)
+            y = torch.cat(ys)
         else:
             x, y = data
 
         if flatten_data:
             x = x.reshape(len(x), -1)
 
+        # Bounding box of the full dataset, computed once. The per-epoch
+        # mesh bounds only need to fold in the (few) prototypes.
+        self._x_min = np.asarray(x).min(0)
+        self._x_max = np.asarray(x).max(0)
+
+        # Fixed label normalization for the decision regions, so their
+        # colors stay aligned with the scatter colors even when a class
+        # first shows up in a later epoch.
+        self._label_norm = Normalize(vmin=float(np.min(np.asarray(y))),
+                                     vmax=float(np.max(np.asarray(y))))
+
+        if len(x) > max_plot_points:
+            # Scatter a fixed subsample so the per-epoch draw cost does not
+            # grow with the dataset size.
+            idx = np.random.default_rng(0).choice(len(x),
+                                                  max_plot_points,
+                                                  replace=False)
+            x, y = x[idx], y[idx]
+
         self.x_train = x
         self.y_train = y
+        self._mesh_cache = None
 
         self.title = title
         self.fig = plt.figure(self.title)
@@ -50,22 +80,118 @@ class Vis2DAbstract(pl.Callback):
         self.border = border
         self.resolution = resolution
         self.axis_off = axis_off
+        self.quantize_mesh = quantize_mesh
+
+        # The data labels never change, so their colors are computed once.
+        self._y_rgba = self.get_rgba(self.y_train)
         self.show_protos = show_protos
         self.show = show
         self.tensorboard = tensorboard
         self.show_last_only = show_last_only
+        self.every_n_epochs = every_n_epochs
         self.pause_time = pause_time
         self.block = block
 
+        # Blitting state: after the first fully composited frame, the
+        # data-dependent artists are updated in-place and redrawn over a
+        # cached background instead of rebuilding the whole figure.
+        self._use_blit = show and not tensorboard and not block
+        self._blit_active = False
+        self._bg = None
+        self._data_artist = None
+        self._proto_artist = None
+        self._edge_artist = None
+        self._mesh_artists = []
+        self._mesh_grid = None
+        self._tb_exec = None
+
     def precheck(self, trainer):
+        if not trainer.is_global_zero:
+            # Only visualize on the rank-zero process under distributed
+            # training to avoid duplicating the mesh predictions.
+            return False
+        if not self.show:
+            if not self.tensorboard or trainer.logger is None:
+                return False  # nowhere to display or log the figure
         if self.show_last_only:
             if trainer.current_epoch != trainer.max_epochs - 1:
                 return False
+        if trainer.current_epoch % self.every_n_epochs != 0:
+            # Throttled, but always visualize the final state.
+            if trainer.current_epoch != trainer.max_epochs - 1:
+                return False
         return True
 
+    def get_mesh(self, x_min, x_max, _components):
+        """Return `(mesh_input, xx, yy)` for the given bounds, reusing the
+        cached mesh.
+
+        The mesh only depends on the bounding box, which rarely changes
+        between epochs. The tensor version of the mesh is cached on the
+        device and dtype of `_components` so that it is not rebuilt and
+        copied over again every epoch.
+        """
+        if self._mesh_cache is not None:
+            lo, hi, mesh_input, xx, yy = self._mesh_cache
+            if np.all(x_min >= lo) and np.all(x_max <= hi):
+                return mesh_input, xx, yy
+        # The bounds outgrew the cached mesh, so the frozen blit view no
+        # longer fits; fall back to a fully composited, re-autoscaled frame.
+        self._deactivate_blit()
+        shift = self.border * (x_max - x_min)
+        # Generate the mesh in float32 so that `torch.from_numpy` shares
+        # memory with the NumPy array instead of copying and upcasting.
+        xx, yy = np.meshgrid(
+            np.linspace(x_min[0] - shift[0],
+                        x_max[0] + shift[0],
+                        self.resolution,
+                        dtype=np.float32),
+            np.linspace(x_min[1] - shift[1],
+                        x_max[1] + shift[1],
+                        self.resolution,
+                        dtype=np.float32),
+        )
+        mesh_input = np.stack([xx.ravel(), yy.ravel()], axis=1)
+        mesh_input = torch.from_numpy(mesh_input).type_as(_components)
+        self._mesh_cache = (x_min, x_max, mesh_input, xx, yy)
+        return mesh_input, xx, yy
+
+    def mesh_predict(self, pl_module, mesh_input):
+        """Predict the mesh labels, optionally through an int8 model copy.
+
+        With `quantize_mesh=True`, the mesh is classified by a dynamically
+        quantized CPU copy of the model, refreshed on every visualized
+        epoch. The decision boundary only needs integer class labels, so
+        the reduced precision is invisible, and user-facing predictions
+        are unaffected. This only pays off for models with linear layers
+        on their predict path.
+        """
+        if not self.quantize_mesh:
+            return pl_module.predict(mesh_input)
+        trainer = pl_module.trainer
+        try:
+            pl_module.trainer = None  # keep the deepcopy to the bare model
+            qmodel = torch.quantization.quantize_dynamic(
+                deepcopy(pl_module).cpu().eval(),
+                {torch.nn.Linear},
+                dtype=torch.qint8,
+            )
+        finally:
+            pl_module.trainer = trainer
+        return qmodel.predict(mesh_input.cpu()).to(mesh_input.device)
+
     def setup_ax(self, xlabel=None, ylabel=None):
         ax = self.fig.gca()
+        if self._blit_active:
+            # Keep the static axes decorations; the data-dependent artists
+            # are updated in-place by the plot methods.
+            return ax
         ax.cla()
+        self._data_artist = None
+        self._proto_artist = None
+        self._edge_artist = None
+        self._mesh_artists = []
+        self._mesh_grid = None
         ax.set_title(self.title)
         if xlabel:
             ax.set_xlabel("Data dimension 1")
@@ -75,45 +201,148 @@ class Vis2DAbstract(pl.Callback):
             ax.axis("off")
         return ax
 
+    def get_rgba(self, labels):
+        """Map labels to RGBA colors in one vectorized colormap lookup.
+
+        Passing the RGBA array to `ax.scatter` bypasses matplotlib's
+        per-draw colormap normalization over all points.
+        """
+        labels = np.asarray(labels)
+        return plt.get_cmap(self.cmap)(Normalize()(labels))
+
     def plot_data(self, ax, x, y):
-        ax.scatter(
-            x[:, 0],
-            x[:, 1],
-            c=y,
-            cmap=self.cmap,
-            edgecolor="k",
-            marker="o",
-            s=30,
-        )
+        if self._data_artist is None:
+            self._data_artist = ax.scatter(
+                x[:, 0],
+                x[:, 1],
+                c=self._y_rgba,
+                edgecolor="k",
+                marker="o",
+                s=30,
+                rasterized=True,
+            )
+        else:
+            self._data_artist.set_offsets(np.asarray(x))
 
     def plot_protos(self, ax, protos, plabels):
-        ax.scatter(
-            protos[:, 0],
-            protos[:, 1],
-            c=plabels,
-            cmap=self.cmap,
-            edgecolor="k",
-            marker="D",
-            s=50,
-        )
+        if isinstance(plabels, str):
+            colors = plabels
+        else:
+            colors = self.get_rgba(plabels)
+        if self._proto_artist is None:
+            self._proto_artist = ax.scatter(
+                protos[:, 0],
+                protos[:, 1],
+                c=colors,
+                edgecolor="k",
+                marker="D",
+                s=50,
+                rasterized=True,
+            )
+        else:
+            self._proto_artist.set_offsets(np.asarray(protos))
+            if not isinstance(colors, str):
+                self._proto_artist.set_facecolor(colors)
+
+    def plot_regions(self, ax, xx, yy, y_pred):
+        if not np.isfinite(xx).all() or not np.isfinite(yy).all():
+            # Diverged model (NaN/inf prototypes): pcolormesh rejects
+            # non-finite coordinates, so skip the region plot instead of
+            # aborting training from inside a visualization callback.
+            return
+        # A rasterized quadmesh is much cheaper than tracing contourf
+        # isobands on a piecewise-constant label field.
+        if self._mesh_artists and xx is self._mesh_grid:
+            self._mesh_artists[0].set_array(np.asarray(y_pred).ravel())
+            return
+        for artist in self._mesh_artists:
+            artist.remove()
+        quadmesh = ax.pcolormesh(xx,
+                                 yy,
+                                 y_pred,
+                                 cmap=self.cmap,
+                                 norm=self._label_norm,
+                                 alpha=0.35,
+                                 shading="nearest",
+                                 rasterized=True)
+        self._mesh_grid = xx
+        self._mesh_artists = [quadmesh]
+        if self._blit_active:
+            quadmesh.set_animated(True)
+
+    def _dynamic_artists(self):
+        artists = [self._data_artist, self._proto_artist, self._edge_artist]
+        artists = [artist for artist in artists if artist is not None]
+        artists += self._mesh_artists
+        return artists
+
+    def _activate_blit(self):
+        """Switch to blit updates after the first fully composited frame."""
+        self.fig.gca().autoscale(enable=False)
+        for artist in self._dynamic_artists():
+            artist.set_animated(True)
+        self._bg = None
+        self._blit_active = True
+
+    def _deactivate_blit(self):
+        """Fall back to full redraws, e.g. when the view bounds change.
+
+        Blitting resumes from the newly autoscaled view after the next
+        fully composited frame.
+        """
+        if not self._blit_active:
+            return
+        for artist in self._dynamic_artists():
+            artist.set_animated(False)
+        self.fig.gca().autoscale(enable=True)
+        self._bg = None
+        self._blit_active = False
+
+    def _blit_frame(self):
+        ax = self.fig.gca()
+        canvas = self.fig.canvas
+        if self._bg is None:
+            canvas.draw()
+            self._bg = canvas.copy_from_bbox(ax.bbox)
+        canvas.restore_region(self._bg)
+        for artist in self._dynamic_artists():
+            ax.draw_artist(artist)
+        canvas.blit(ax.bbox)
+        canvas.flush_events()
 
     def add_to_tensorboard(self, trainer, pl_module):
         tb = pl_module.logger.experiment
-        tb.add_figure(tag=f"{self.title}",
-                      figure=self.fig,
-                      global_step=trainer.current_epoch,
-                      close=False)
+        # Rasterize on the training thread (matplotlib is not thread-safe)
+        # but hand the frame off to a worker, so image encoding and the
+        # event-file write overlap with the next epoch.
+        canvas = self.fig.canvas
+        canvas.draw()
+        frame = np.asarray(canvas.buffer_rgba()).copy()
+        if self._tb_exec is None:
+            self._tb_exec = ThreadPoolExecutor(max_workers=1)
+        self._tb_exec.submit(tb.add_image,
+                             f"{self.title}",
+                             frame,
+                             global_step=trainer.current_epoch,
+                             dataformats="HWC")
 
     def log_and_display(self, trainer, pl_module):
         if self.tensorboard:
             self.add_to_tensorboard(trainer, pl_module)
         if self.show:
-            if not self.block:
+            if self._blit_active:
+                self._blit_frame()
+            elif not self.block:
                 plt.pause(self.pause_time)
+                if self._use_blit and self._dynamic_artists():
+                    self._activate_blit()
             else:
                 plt.show(block=self.block)
 
     def on_train_end(self, trainer, pl_module):
+        if self._tb_exec is not None:
+            self._tb_exec.shutdown(wait=True)
+            self._tb_exec = None
         plt.close()
 
 
@@ -129,13 +358,17 @@ class VisGLVQ2D(Vis2DAbstract):
                            ylabel="Data dimension 2")
         self.plot_data(ax, x_train, y_train)
         self.plot_protos(ax, protos, plabels)
-        x = np.vstack((x_train, protos))
-        mesh_input, xx, yy = mesh2d(x, self.border, self.resolution)
+        protos_np = np.asarray(protos)
+        x_min = np.minimum(self._x_min, protos_np.min(0))
+        x_max = np.maximum(self._x_max, protos_np.max(0))
         _components = pl_module.proto_layer._components
-        mesh_input = torch.from_numpy(mesh_input).type_as(_components)
-        y_pred = pl_module.predict(mesh_input)
-        y_pred = y_pred.cpu().reshape(xx.shape)
-        ax.contourf(xx, yy, y_pred, cmap=self.cmap, alpha=0.35)
+        mesh_input, xx, yy = self.get_mesh(x_min, x_max, _components)
+        pl_module.eval()
+        with torch.inference_mode():
+            y_pred = self.mesh_predict(pl_module, mesh_input)
+        pl_module.train()
+        y_pred = y_pred.reshape(xx.shape).cpu().numpy()
+        self.plot_regions(ax, xx, yy, y_pred)
 
         self.log_and_display(trainer, pl_module)
 
@@ -153,27 +386,39 @@ class VisSiameseGLVQ2D(Vis2DAbstract):
         plabels = pl_module.prototype_labels
         x_train, y_train = self.x_train, self.y_train
         device = pl_module.device
-        with torch.no_grad():
-            x_train = pl_module.backbone(torch.Tensor(x_train).to(device))
-            x_train = x_train.cpu().detach()
-        if self.map_protos:
-            with torch.no_grad():
-                protos = pl_module.backbone(torch.Tensor(protos).to(device))
-                protos = protos.cpu().detach()
+        pl_module.eval()
+        with torch.inference_mode():
+            if self.map_protos:
+                # Map data and prototypes in a single backbone call.
+                batch = torch.cat([
+                    torch.as_tensor(x_train, dtype=torch.float32),
+                    torch.as_tensor(protos, dtype=torch.float32),
+                ]).to(device)
+                mapped = pl_module.backbone(batch).cpu()
+                x_train, protos = mapped[:len(x_train)], mapped[len(x_train):]
+            else:
+                x_train = pl_module.backbone(
+                    torch.as_tensor(x_train,
+                                    dtype=torch.float32).to(device)).cpu()
         ax = self.setup_ax()
         self.plot_data(ax, x_train, y_train)
+        _components = pl_module.proto_layer._components
+        # The latent space moves every epoch, so the bounds cannot be
+        # precomputed here; the mapped data is small after subsampling.
+        x_train_np = np.asarray(x_train)
+        x_min, x_max = x_train_np.min(0), x_train_np.max(0)
         if self.show_protos:
             self.plot_protos(ax, protos, plabels)
-            x = np.vstack((x_train, protos))
-            mesh_input, xx, yy = mesh2d(x, self.border, self.resolution)
-        else:
-            mesh_input, xx, yy = mesh2d(x_train, self.border, self.resolution)
-        _components = pl_module.proto_layer._components
-        mesh_input = torch.Tensor(mesh_input).type_as(_components)
-        y_pred = pl_module.predict_latent(mesh_input,
-                                          map_protos=self.map_protos)
-        y_pred = y_pred.cpu().reshape(xx.shape)
-        ax.contourf(xx, yy, y_pred, cmap=self.cmap, alpha=0.35)
+            protos_np = np.asarray(protos)
+            x_min = np.minimum(x_min, protos_np.min(0))
+            x_max = np.maximum(x_max, protos_np.max(0))
+        mesh_input, xx, yy = self.get_mesh(x_min, x_max, _components)
+        with torch.inference_mode():
+            y_pred = pl_module.predict_latent(mesh_input,
+                                              map_protos=self.map_protos)
+        pl_module.train()
+        y_pred = y_pred.reshape(xx.shape).cpu().numpy()
+        self.plot_regions(ax, xx, yy, y_pred)
 
         self.log_and_display(trainer, pl_module)
 
@@ -189,14 +434,18 @@ class VisCBC2D(Vis2DAbstract):
                            ylabel="Data dimension 2")
         self.plot_data(ax, x_train, y_train)
         self.plot_protos(ax, protos, "w")
-        x = np.vstack((x_train, protos))
-        mesh_input, xx, yy = mesh2d(x, self.border, self.resolution)
+        protos_np = np.asarray(protos)
+        x_min = np.minimum(self._x_min, protos_np.min(0))
+        x_max = np.maximum(self._x_max, protos_np.max(0))
         _components = pl_module.components_layer._components
-        y_pred = pl_module.predict(
-            torch.Tensor(mesh_input).type_as(_components))
-        y_pred = y_pred.cpu().reshape(xx.shape)
+        mesh_input, xx, yy = self.get_mesh(x_min, x_max, _components)
+        pl_module.eval()
+        with torch.inference_mode():
+            y_pred = self.mesh_predict(pl_module, mesh_input)
+        pl_module.train()
+        y_pred = y_pred.reshape(xx.shape).cpu().numpy()
 
-        ax.contourf(xx, yy, y_pred, cmap=self.cmap, alpha=0.35)
+        self.plot_regions(ax, xx, yy, y_pred)
 
         self.log_and_display(trainer, pl_module)
 
@@ -208,22 +457,24 @@ class VisNG2D(Vis2DAbstract):
 
         x_train, y_train = self.x_train, self.y_train
         protos = pl_module.prototypes
-        cmat = pl_module.topology_layer.cmat.cpu().numpy()
+        cmat = pl_module.topology_layer.cmat.detach().cpu().numpy()
 
         ax = self.setup_ax(xlabel="Data dimension 1",
                            ylabel="Data dimension 2")
         self.plot_data(ax, x_train, y_train)
         self.plot_protos(ax, protos, "w")
 
-        # Draw connections
-        for i in range(len(protos)):
-            for j in range(i, len(protos)):
-                if cmat[i][j]:
-                    ax.plot(
-                        [protos[i, 0], protos[j, 0]],
-                        [protos[i, 1], protos[j, 1]],
-                        "k-",
-                    )
+        # Draw connections as a single collection instead of one artist per
+        # edge, which quickly overwhelms matplotlib for large topologies.
+        protos_np = np.asarray(protos)
+        i, j = np.nonzero(np.triu(cmat != 0, k=1))
+        segments = np.stack([protos_np[i], protos_np[j]], axis=1)
+        if self._edge_artist is not None:
+            self._edge_artist.remove()
+        self._edge_artist = ax.add_collection(
+            LineCollection(segments, colors="k", linewidths=1))
+        if self._blit_active:
+            self._edge_artist.set_animated(True)
 
         self.log_and_display(trainer, pl_module)
 